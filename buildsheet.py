@@ -1,34 +1,83 @@
 from lxml import etree as ET
 from reportlab.pdfgen import canvas
 from reportlab.lib import colors
+from reportlab.pdfbase.pdfmetrics import stringWidth
+import collections
+import functools
 import math
 import re
 import sys
 
 NORMAL_COLOR = colors.lightgrey
 HIGHLIGHT_COLOR = colors.black
+HEADING_FONT = "Helvetica"
 
 angle_re = re.compile(r"^(M?)R(\d+)(?:\.\d+)?$")
 prefix_re = re.compile(r"\s*([A-Za-z]+)\s*\d+\s*$")
 
-def rotate_coords(xy, angle):
+smd_xpath = ET.XPath("smd")
+
+# Boards use only a handful of distinct rotations, so parsed values are
+# memoized by their 'rot' string.
+_ROT_CACHE = { }
+
+def parse_rot(rot):
+    r = _ROT_CACHE.get(rot)
+    if r is None:
+        m = angle_re.match(rot)
+        if not m:
+            raise Exception("Could not parse angle '%s'" % rot)
+        r = (float(m.group(2)), m.group(1) == "M")
+        _ROT_CACHE[rot] = r
+    return r
+
+_AXIS_ROTATIONS = { 0: (1.0, 0.0), 90: (0.0, 1.0), 180: (-1.0, 0.0), 270: (0.0, -1.0) }
+
+@functools.lru_cache(maxsize=64)
+def _cs(angle):
+    if angle in _AXIS_ROTATIONS:
+        return _AXIS_ROTATIONS[angle]
+    a = (angle/180)*math.pi
+    return math.cos(a), math.sin(a)
+
+# Returns (cos, sin) for an angle in degrees.
+def rotation(angle):
     if angle is None:
+        return (1.0, 0.0)
+    # Parsed angles are always whole degrees (see angle_re).
+    return _cs(int(round(angle)) % 360)
+
+def rotate_coords(xy, angle):
+    if angle is None or angle == 0:
         return xy
-    angle = (angle/180)*math.pi
     x, y = xy
-    x2 = (x * math.cos(angle)) - (y * math.sin(angle))
-    y2 = (x * math.sin(angle)) + (y * math.cos(angle))
+    if angle == 90:
+        return -y, x
+    elif angle == 180:
+        return -x, -y
+    elif angle == 270:
+        return y, -x
+    cos_a, sin_a = rotation(angle)
+    x2 = (x * cos_a) - (y * sin_a)
+    y2 = (x * sin_a) + (y * cos_a)
     return x2, y2
 
 class BoardInfo():
     def __init__(self):
-        self.value_to_components = { }
+        self.value_to_components = collections.defaultdict(list)
         self.name_to_component = { }
-        self.layer_to_components = { }
-        self.layer_value_to_components = { }
+        self.layer_to_components = collections.defaultdict(list)
+        self.layer_value_to_components = collections.defaultdict(list)
+        self.layer_value_to_prefixes = collections.defaultdict(list)
+        self.layer_value_prefix_to_components = collections.defaultdict(list)
+        self.layer_value_prefix_to_names = { }
+        self.layer_value_prefix_to_names_str = { }
         self.components = [ ]
 
 class Component():
+    __slots__ = ('x', 'y', 'name', 'prefix', 'value', 'pads', 'angle', 'layer',
+                 'rotation', 'world_rects', 'world_pads')
+
     def __init__(self, x, y, name, prefix, value, pads, angle, layer):
         self.x = x
         self.y = y
@@ -38,8 +87,11 @@ class Component():
         self.pads = pads
         self.angle = angle
         self.layer = layer
+        self.rotation = rotation(angle)
 
 class Pad():
+    __slots__ = ('x', 'y', 'width', 'height', 'angle', 'corners')
+
     def __init__(self, x, y, width, height, angle):
         self.x = x
         self.y = y
@@ -47,51 +99,235 @@ class Pad():
         self.height = height
         self.angle = angle
 
-def getfloat(elem, name):
-    f = elem.get(name)
-    if f is None:
-        raise Exception("Expecting attribute '%s'" % name)
-    v = None
-    try:
-        v = float(f)
-    except ValueError:
-        raise Exception("Non-float value for attribute '%s'" % name)
-    return v
+        # Corners relative to the component origin, before the component's
+        # own rotation is applied. These go anticlockwise, the same way as
+        # the PDF 're' operator, so that pads drawn as paths and as rects
+        # wind consistently.
+        corners = [(-(width/2), -(height/2)),
+                   ((width/2), -(height/2)),
+                   ((width/2), (height/2)),
+                   (-(width/2), (height/2))]
+        corners = [rotate_coords(cr, angle) for cr in corners]
+        self.corners = [(cr[0] + x, cr[1] + y) for cr in corners]
+
+
+# Layer numbers are interned, since they are compared against every pad's
+# layer and used as keys in the component indices.
+def get_layer_number(layer_number_by_name, name, default):
+    if name not in layer_number_by_name:
+        raise Exception("Could not find %s layer def" % name)
+    number = layer_number_by_name[name]
+    if number is None:
+        number = default
+    return sys.intern(number)
+
+def get_layer_numbers(bi, layer_number_by_name):
+    bi.dimension_layer_number = get_layer_number(layer_number_by_name, "Dimension", "20")
+    bi.top_layer = get_layer_number(layer_number_by_name, "Top", "1")
+    bi.bottom_layer = get_layer_number(layer_number_by_name, "Bottom", "16")
+
+def get_component(bi, c, packages_by_name):
+    compname = c.get("name")
+    if compname is None or compname == '':
+        raise Exception("Component without name")
+
+    compprefix = None
+    m = prefix_re.match(compname)
+    if m:
+        compprefix = m.group(1)
+
+    compvalue = c.get("value")
+    if compvalue is None:
+        raise Exception("Component without value")
+
+    package_name = c.get("package")
+    if package_name is None:
+        raise Exception("Component without package")
+    # Find the package.
+    package = packages_by_name.get(package_name)
+    if package is None:
+        raise Exception("Could not find package")
+    ppads = smd_xpath(package)
+    if len(ppads) == 0:
+        print("Skipping package '%s' (component '%s') since it has no pads" % (package_name, compname))
+        return None
+
+    # Missing or malformed numeric attributes raise KeyError/ValueError,
+    # which get_board_info reports along with the element being processed.
+    ca = c.attrib
+    compx = float(ca["x"])
+    compy = float(ca["y"])
+
+    rot = c.get("rot")
+    eangle = None
+    mirrored = False
+    if rot is not None:
+        eangle, mirrored = parse_rot(rot)
+
+    ourpads = [ ]
+    complayer = None # Assume that all component's pads will be on same layer.
+    for p in ppads:
+        pa = p.attrib
+        if pa.get("layer") is None:
+            raise Exception("Could not get pad layer")
+
+        if complayer is None:
+            complayer = sys.intern(pa.get("layer"))
+            if mirrored:
+                if complayer == bi.top_layer:
+                    complayer = bi.bottom_layer
+                elif complayer == bi.bottom_layer:
+                    complayer = bi.top_layer
+
+        x = float(pa["x"])
+        y = float(pa["y"])
+
+        # Get angle.
+        rot = pa.get("rot")
+        pangle = None
+        if rot is not None:
+            pangle, _ = parse_rot(rot)
+
+        op = Pad(x = x,
+                 y = y,
+                 width = float(pa["dx"]),
+                 height = float(pa["dy"]),
+                 angle = pangle)
+        ourpads.append(op)
+
+    com = Component(
+        x = compx,
+        y = compy,
+        name=compname,
+        prefix=compprefix,
+        value=compvalue,
+        pads=ourpads,
+        angle=eangle,
+        layer=complayer
+    )
+    return com
+
+def is_right_angle(angle):
+    return angle is None or angle % 90 == 0
+
+# Returns the page coordinates of the component's pads in two lists: axis
+# aligned pads as (x, y, width, height) rects, and the others as lists of
+# corners.
+def get_world_pads(bi, c):
+    cos_a, sin_a = c.rotation
+    ox, oy = c.x - bi.xmin, c.y - bi.ymin
+    rects = [ ]
+    polys = [ ]
+    c_right_angle = is_right_angle(c.angle)
+    for p in c.pads:
+        if c_right_angle and is_right_angle(p.angle):
+            # Only the centre needs transforming; the pad's extent just
+            # swaps over if it ends up turned by 90 or 270 degrees.
+            cx = (p.x * cos_a) - (p.y * sin_a) + ox
+            cy = (p.x * sin_a) + (p.y * cos_a) + oy
+            w, h = p.width, p.height
+            if ((p.angle or 0) + (c.angle or 0)) % 180 != 0:
+                w, h = h, w
+            rects.append((cx - (w/2), cy - (h/2), w, h))
+        else:
+            polys.append([((x * cos_a) - (y * sin_a) + ox, (x * sin_a) + (y * cos_a) + oy) for x, y in p.corners])
+    return rects, polys
 
+# Frees an element that has been processed, along with any siblings before
+# it (which will have been dealt with already).
+def free_element(elem):
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
 
 def get_board_info(filename):
     bi = BoardInfo()
 
-    tree = ET.parse(filename)
-    root = tree.getroot()
-
-    # Get the number of the dimension layer.
-    dl = root.xpath("//layer[@name='Dimension']")
-    if len(dl) == 0:
-        raise Exception("Could not find Dimension layer def")
-    bi.dimension_layer_number = dl[0].get('number', 20)
-
-    # Get the numbers of the top and bottom layers.
-    tl = root.xpath("//layer[@name='Top']")
-    if (len(tl) == 0):
-        raise Exception("Could not find Top layer def")
-    bi.top_layer = tl[0].get('number', '1')
-    bl = root.xpath("//layer[@name='Bottom']")
-    if (len(bl) == 0):
-        raise Exception("Could not find Bottom layer def")
-    bi.bottom_layer = bl[0].get('number', '16')
-
-    # Get the bounding rectangle from the dimension layer wires.
-    ws = root.xpath("//wire[@layer='20']")
-    if len(ws) < 2:
-        raise Exception("Error processing dimension layer wires")
+    layer_number_by_name = { }
+    packages_by_name = { }
+    have_layer_numbers = False
+
+    nwires = 0
     xmin, ymin = float('+inf'), float('+inf')
     xmax, ymax = float('-inf'), float('-inf')
-    for w in ws:
-        xmin = min(xmin, getfloat(w, "x1"), getfloat(w, "x2"))
-        ymin = min(ymin, getfloat(w, "y1"), getfloat(w, "y2"))
-        xmax = max(xmax, getfloat(w, "x1"), getfloat(w, "x2"))
-        ymax = max(ymax, getfloat(w, "y1"), getfloat(w, "y2"))
+
+    ourcomps = [ ]
+
+    # The file is streamed so that wires, components and signals can be freed
+    # as soon as they have been processed. Packages are kept until the end,
+    # since components look up their pads in them.
+    try:
+        for _, elem in ET.iterparse(filename, events=("end",), tag=("layer", "wire", "package", "element", "plain", "signal")):
+            if elem.tag == "layer":
+                layer_number_by_name.setdefault(elem.get("name"), elem.get("number"))
+                elem.clear()
+                continue
+            if elem.tag == "package":
+                packages_by_name.setdefault(elem.get("name"), elem)
+                continue
+            if elem.tag == "plain" or elem.tag == "signal":
+                free_element(elem)
+                continue
+
+            # Layer defs precede the board itself in an Eagle file.
+            if not have_layer_numbers:
+                get_layer_numbers(bi, layer_number_by_name)
+                have_layer_numbers = True
+
+            if elem.tag == "wire":
+                # Get the bounding rectangle from the dimension layer wires.
+                wa = elem.attrib
+                if wa.get("layer") == bi.dimension_layer_number:
+                    nwires += 1
+                    x1, x2 = float(wa["x1"]), float(wa["x2"])
+                    y1, y2 = float(wa["y1"]), float(wa["y2"])
+                    if x1 > x2:
+                        x1, x2 = x2, x1
+                    if y1 > y2:
+                        y1, y2 = y2, y1
+                    if x1 < xmin:
+                        xmin = x1
+                    if x2 > xmax:
+                        xmax = x2
+                    if y1 < ymin:
+                        ymin = y1
+                    if y2 > ymax:
+                        ymax = y2
+                # Wires in a package sit alongside its pads, which are
+                # still needed.
+                if elem.getparent().tag == "package":
+                    elem.clear()
+                else:
+                    free_element(elem)
+                continue
+
+            com = get_component(bi, elem, packages_by_name)
+            free_element(elem)
+            if com is None:
+                continue
+
+            ourcomps.append(com)
+
+            bi.name_to_component[com.name] = com
+            bi.value_to_components[com.value].append(com)
+            bi.layer_to_components[com.layer].append(com)
+            bi.layer_value_to_components[(com.layer, com.value)].append(com)
+
+            k = (com.layer, com.value, com.prefix)
+            if k not in bi.layer_value_prefix_to_components:
+                bi.layer_value_to_prefixes[(com.layer, com.value)].append(com.prefix)
+            bi.layer_value_prefix_to_components[k].append(com)
+    except (KeyError, ValueError) as e:
+        desc = "<%s>" % elem.tag
+        if elem.get("name"):
+            desc += " '%s'" % elem.get("name")
+        raise Exception("Bad or missing attribute in %s: %s" % (desc, e))
+
+    if not have_layer_numbers:
+        get_layer_numbers(bi, layer_number_by_name)
+
+    if nwires < 2:
+        raise Exception("Error processing dimension layer wires")
     bi.xmin = xmin
     bi.xmax = xmax
     bi.ymin = ymin
@@ -99,138 +335,64 @@ def get_board_info(filename):
     bi.width = xmax - xmin
     bi.height = ymax - ymin
 
-    # Get components.
-    comps = root.xpath("//element")
-    ourcomps = [ ]
-    for c in comps:
-        compname = c.get("name")
-        if compname is None or compname == '':
-            raise Exception("Component without name")
-
-        compprefix = None
-        m = re.match(prefix_re, compname)
-        if m:
-            compprefix = m.group(1)
-
-        compvalue = c.get("value")
-        if compvalue is None:
-            raise Exception("Component without value")
-
-        package_name = c.get("package")
-        if package_name is None:
-            raise Exception("Component without package")
-        # Find the package.
-        package = root.xpath("//package[@name='%s']" % package_name)
-        if len(package) == 0:
-            raise Exception("Could not find package")
-        ppads = package[0].xpath("smd")
-        if len(ppads) == 0:
-            print("Skipping package '%s' (component '%s') since it has no pads" % (package_name, compname))
-            continue
+    # Pad geometry is the same on every page, so work out the page
+    # coordinates of each pad's corners up front.
+    for com in ourcomps:
+        com.world_rects, com.world_pads = get_world_pads(bi, com)
 
-        compx = getfloat(c, "x")
-        compy = getfloat(c, "y")
-
-        rot = c.get("rot")
-        eangle = None
-        mirrored = False
-        if rot is not None:
-            m = re.match(angle_re, rot)
-            if not m:
-                raise Exception("Could not parse angle '%s'" % rot)
-            eangle = float(m.group(2))
-            mirrored = (m.group(1) == "M")
-
-        ourpads = [ ]
-        complayer = None # Assume that all component's pads will be on same layer.
-        for p in ppads:
-            if p.get("layer") is None:
-                raise Exception("Could not get pad layer")
-
-            if complayer is None:
-                complayer = p.get("layer")
-                if mirrored:
-                    if complayer == bi.top_layer:
-                        complayer = bi.bottom_layer
-                    elif complayer == bi.bottom_layer:
-                        complayer = bi.top_layer
-
-            x = getfloat(p, "x")
-            y = getfloat(p, "y")
-
-            # Get angle.
-            rot = p.get("rot")
-            pangle = None
-            if rot is not None:
-                m = re.match(angle_re, rot)
-                if not m:
-                    raise Exception("Could not parse angle")
-                pangle = float(m.group(2))
-
-            op = Pad(x = x,
-                     y = y,
-                     width = getfloat(p, "dx"),
-                     height = getfloat(p, "dy"),
-                     angle = pangle)
-            ourpads.append(op)
-
-        com = Component(
-            x = compx,
-            y = compy,
-            name=compname,
-            prefix=compprefix,
-            value=compvalue,
-            pads=ourpads,
-            angle=eangle,
-            layer=complayer
-        )
-        ourcomps.append(com)
-
-        bi.name_to_component[compname] = com
-        if compvalue in bi.value_to_components:
-            bi.value_to_components[compvalue].append(com)
-        else:
-            bi.value_to_components[compvalue] = [com]
-
-        if complayer in bi.layer_to_components:
-            bi.layer_to_components[complayer].append(com)
-        else:
-            bi.layer_to_components[complayer] = [com]
-
-        if (complayer, compvalue) in bi.layer_value_to_components:
-            bi.layer_value_to_components[(complayer, compvalue)].append(com)
-        else:
-            bi.layer_value_to_components[(complayer, compvalue)] = [com]
+    for k, cs in bi.layer_value_prefix_to_components.items():
+        names = sorted(c.name for c in cs)
+        bi.layer_value_prefix_to_names[k] = names
+        bi.layer_value_prefix_to_names_str[k] = ','.join(names)
 
     bi.components = ourcomps
     return bi
 
-def render_component_pad(cv, bi, c, p, highlight):
-    corners = [(-(p.width/2), -(p.height/2)),
-               ((-(p.width/2), (p.height/2))),
-               ((p.width/2), (p.height/2)),
-               ((p.width/2), -(p.height/2))]
-    corners = [rotate_coords(cr, p.angle) for cr in corners]
-    corners = [(cr[0] + p.x, cr[1] + p.y) for cr in corners]
-    corners = [rotate_coords((cr[0], cr[1]), c.angle) for cr in corners]
-    corners = [(cr[0] + c.x, cr[1] + c.y) for cr in corners]
-    pth = cv.beginPath()
-    pth.moveTo(corners[0][0] - bi.xmin, corners[0][1] - bi.ymin)
+def add_component_pad(pth, corners):
+    pth.moveTo(corners[0][0], corners[0][1])
     for i in range(1, len(corners)):
-        pth.lineTo(corners[i][0] - bi.xmin, corners[i][1] - bi.ymin)
-    cv.setFillColor(HIGHLIGHT_COLOR if highlight else NORMAL_COLOR)
-    cv.drawPath(pth, fill=1, stroke=0)
+        pth.lineTo(corners[i][0], corners[i][1])
 
-def render_components(cv, bi, all_cs, val_cs):
-    for c in all_cs:
-        if c in val_cs:
-            continue
-        for p in c.pads:
-            render_component_pad(cv, bi, c, p, highlight=False)
-
-    for c in val_cs:
-        for p in c.pads:
-            render_component_pad(cv, bi, c, p, highlight=True)
+def render_pads(cv, cs, color):
+    if len(cs) == 0:
+        return
+    # All pads go into a single path, filled non-zero so that any
+    # overlapping pads don't cancel each other out.
+    pth = cv.beginPath()
+    for c in cs:
+        for x, y, w, h in c.world_rects:
+            pth.rect(x, y, w, h)
+        for corners in c.world_pads:
+            add_component_pad(pth, corners)
+    cv.setFillColor(color)
+    cv.drawPath(pth, fill=1, stroke=0, fillMode=canvas.FILL_NON_ZERO)
+
+# Long name lists (e.g. hundreds of resistors sharing a value) are cut short
+# with an ellipsis so that the heading fits across the page.
+def get_heading(val, names, names_str, width, fontsize):
+    heading = "V = %s, N = %s" % (val, names_str)
+    if stringWidth(heading, HEADING_FONT, fontsize) <= width:
+        return heading
+
+    start = "V = %s, N = " % val
+    avail = width - stringWidth(start + ",...", HEADING_FONT, fontsize)
+    comma = stringWidth(",", HEADING_FONT, fontsize)
+    used = 0
+    n = 0
+    for name in names:
+        w = stringWidth(name, HEADING_FONT, fontsize)
+        if n > 0:
+            w += comma
+        if used + w > avail:
+            break
+        used += w
+        n += 1
+
+    if n == 0:
+        return start + "..."
+    if n < len(names):
+        return start + ','.join(names[:n]) + ",..."
+    return heading
 
 def layout_by_same_value(cv, bi, layer):
     headingspace = bi.height / 10.0
@@ -239,28 +401,40 @@ def layout_by_same_value(cv, bi, layer):
 
     cv.setPageSize((cwidth, cheight))
 
+    # Note that the font has to be set on every page, as showPage resets
+    # the graphics state.
+    fontsize = headingspace/5.0
+
+    # Every page shows the whole layer with some of its components
+    # highlighted, so draw the layer once as a form and overlay the
+    # highlighted pads on top of it on each page.
+    layer_form_name = "board_layer_%s" % layer
+    cv.beginForm(layer_form_name)
+    render_pads(cv, bi.layer_to_components.get(layer, []), NORMAL_COLOR)
+    cv.endForm()
+
     values = bi.value_to_components.keys()
-    for val in values:
+    for i, val in enumerate(values):
         val_cs = bi.layer_value_to_components.get((layer, val))
         if val_cs is None:
             continue
 
-        prefixes = { }
-        for vc in val_cs:
-            if vc.prefix in prefixes:
-                prefixes[vc.prefix].append(vc)
-            else:
-                prefixes[vc.prefix] = [vc]
-
-        all_cs = bi.layer_to_components.get(layer, [])
-
-        for prefix_cs in prefixes.values():
-            names = [c.name for c in prefix_cs]
-            names.sort()
-
-            cv.setFont("Helvetica", headingspace/5.0)
-            cv.drawCentredString(cwidth/2, cheight-(headingspace/2.0), "V = %s, N = %s" % (val, ','.join(names)))
-            render_components(cv, bi, all_cs, val_cs)
+        # The highlighted components are the same for every prefix of a
+        # value, so they also go in a form that is reused on each page.
+        form_name = "layer%s_value%d" % (layer, i)
+        cv.beginForm(form_name)
+        render_pads(cv, val_cs, HIGHLIGHT_COLOR)
+        cv.endForm()
+
+        for prefix in bi.layer_value_to_prefixes[(layer, val)]:
+            k = (layer, val, prefix)
+            names = bi.layer_value_prefix_to_names[k]
+            names_str = bi.layer_value_prefix_to_names_str[k]
+
+            cv.setFont(HEADING_FONT, fontsize)
+            cv.drawCentredString(cwidth/2, cheight-(headingspace/2.0), get_heading(val, names, names_str, cwidth, fontsize))
+            cv.doForm(layer_form_name)
+            cv.doForm(form_name)
             cv.showPage()
 
 if __name__ == '__main__':